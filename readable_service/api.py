@@ -3,22 +3,34 @@ import subprocess
 subprocess.run(["playwright", "install", "chromium"])
 
 import redis
+import asyncio
+import contextlib
 import hashlib
+import math
 import os
 import json
+import time
 import urllib.parse as urlparse
 
-from bs4 import BeautifulSoup
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional
 
 try:
-    from readability import Readable
+    from readability import DeadlineExceeded, Readable
 except ImportError:
-    from readable_service.readability import Readable
+    from readable_service.readability import DeadlineExceeded, Readable
+
+# Deadlines (seconds). Requests may ask for a shorter or longer timeout, capped at the server max.
+DEFAULT_TIMEOUT = float(os.getenv("CONVERT_DEFAULT_TIMEOUT", 30))
+MAX_TIMEOUT = float(os.getenv("CONVERT_MAX_TIMEOUT", 60))
+
+# Load shedding, per worker process
+MAX_IN_FLIGHT = int(os.getenv("CONVERT_MAX_IN_FLIGHT", 4))
+MAX_QUEUED = int(os.getenv("CONVERT_MAX_QUEUED", 16))
+MAX_QUEUE_WAIT = float(os.getenv("CONVERT_MAX_QUEUE_WAIT", 5))
 
 # Initialize Redis client
 redis_client = None
@@ -58,9 +70,80 @@ def healthcheck():
     return "OK"
 
 
+class Overloaded(Exception):
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Caps concurrent browser renders and sheds load instead of letting the queue grow.
+
+    Requests beyond `max_in_flight` wait in a queue. Once `max_queued` requests are waiting, new ones
+    are rejected with 429. A request that waits longer than `max_queue_wait` is rejected with 503.
+    """
+
+    def __init__(self, max_in_flight, max_queued, max_queue_wait):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait
+        self.in_flight = 0
+        self.queued = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    def _retry_after(self):
+        # Rough time for the current backlog to drain, assuming renders take about max_queue_wait
+        return max(1, math.ceil(self.max_queue_wait * (self.queued + 1) / self.max_in_flight))
+
+    @contextlib.asynccontextmanager
+    async def admit(self, timeout):
+        if self.in_flight + self.queued >= self.max_in_flight + self.max_queued:
+            raise Overloaded("Too many queued requests", 429, self._retry_after())
+
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), min(self.max_queue_wait, timeout))
+        except asyncio.TimeoutError:
+            raise Overloaded("Timed out waiting for a free renderer", 503, self._retry_after())
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+
+admission = AdmissionController(MAX_IN_FLIGHT, MAX_QUEUED, MAX_QUEUE_WAIT)
+
+
+def _get_timeout(timeout):
+    return min(DEFAULT_TIMEOUT if timeout is None else timeout, MAX_TIMEOUT)
+
+
+async def _run_until_disconnect(request, coro, poll_interval=0.5):
+    # Runs coro, cancelling it if the client goes away. Returns False if it was cancelled.
+    task = asyncio.create_task(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=poll_interval)
+        if done:
+            task.result()
+            return True
+        if await request.is_disconnected():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            return False
+
+
 class URLInput(BaseModel):
     url: str
     is_blog: bool
+    # Seconds, capped at CONVERT_MAX_TIMEOUT
+    timeout: Optional[float] = Field(None, gt=0)
 
 
 class ContentOutput(BaseModel):
@@ -70,7 +153,8 @@ class ContentOutput(BaseModel):
 
 
 @app.post("/convert", response_model=ContentOutput)
-async def convert(inp: URLInput, response: Response):
+async def convert(inp: URLInput, request: Request, response: Response):
+    deadline = time.monotonic() + _get_timeout(inp.timeout)
     url = inp.url
     # check if url is in redis
     unique_key = hashlib.sha256(f"{url}{inp.is_blog}".encode()).hexdigest()
@@ -79,10 +163,27 @@ async def convert(inp: URLInput, response: Response):
         return json.loads(cached_data)
 
     # If not, run the Readable algorithm
+    # Cancelled or timed out work may still be finishing in a thread, so those paths return
+    # straight away rather than reading (and caching) a half-populated result.
     title, text, err = "", "", ""
+    tmp = Readable()
     try:
-        tmp = Readable()
-        await tmp.arun(url)
+        async with admission.admit(deadline - time.monotonic()):
+            remaining = deadline - time.monotonic()
+            # wait_for is a backstop for anything that doesn't honour the deadline itself
+            coro = asyncio.wait_for(tmp.arun(url, timeout=remaining), remaining)
+            if not await _run_until_disconnect(request, coro):
+                print(f"Client disconnected, cancelled: {url}")
+                response.status_code = 499
+                return {"title": "", "text": "", "error": "Client disconnected"}
+    except Overloaded as e:
+        response.status_code = e.status_code
+        response.headers["Retry-After"] = str(e.retry_after)
+        return {"title": "", "text": "", "error": str(e)}
+    except (DeadlineExceeded, asyncio.TimeoutError) as e:
+        print(f"Deadline exceeded: {url}")
+        response.status_code = 504
+        return {"title": "", "text": "", "error": str(e) or "Deadline exceeded"}
     except Exception as e:
         err = str(e)
         print(e)
@@ -92,8 +193,7 @@ async def convert(inp: URLInput, response: Response):
     article_content = tmp.article_content if hasattr(tmp, "article_content") else ""
 
     if article_content:
-        soup = BeautifulSoup(tmp.article_content, "lxml")
-        text = soup.get_text() if inp.is_blog else tmp.text
+        text = tmp.article_text if inp.is_blog else tmp.text
 
     print(f"text: {text[:100]}")
     print(f"title: {title}")
@@ -112,6 +212,8 @@ async def convert(inp: URLInput, response: Response):
 
 class ContentIn(BaseModel):
     html: str
+    # Seconds, capped at CONVERT_MAX_TIMEOUT
+    timeout: Optional[float] = Field(None, gt=0)
 
 
 @app.post("/convert/html", response_model=ContentOutput)
@@ -119,7 +221,11 @@ def convert_html(inp: ContentIn, response: Response):
     title, text, err = "", "", ""
     try:
         tmp = Readable()
-        tmp.run_html(inp.html)
+        tmp.run_html(inp.html, timeout=_get_timeout(inp.timeout))
+    except DeadlineExceeded as e:
+        print(e)
+        response.status_code = 504
+        return {"title": "", "text": "", "error": str(e)}
     except Exception as e:
         err = str(e)
         print(e)
@@ -129,8 +235,7 @@ def convert_html(inp: ContentIn, response: Response):
     article_content = tmp.article_content if hasattr(tmp, "article_content") else ""
 
     if article_content:
-        soup = BeautifulSoup(tmp.article_content, "lxml")
-        text = soup.get_text()
+        text = tmp.article_text
 
     print(f"text: {text[:100]}")
     print(f"title: {title}")
@@ -0,0 +1,408 @@
+"""Offline bulk extraction over stored HTML.
+
+Runs `Readable.run_html` over WARC files, (gzipped) JSONL files or directories of HTML
+files across a process pool. No browser and no network are involved.
+
+    python -m readable_service.bulk crawl.warc.gz pages.jsonl.gz html_dir/ -o out.jsonl
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+
+from loguru import logger
+from multiprocessing import Pool
+
+try:
+    from readability import Readable
+except ImportError:
+    from readable_service.readability import Readable
+
+
+HTML_SUFFIXES = (".html", ".htm", ".html.gz", ".htm.gz")
+WARC_SUFFIXES = (".warc", ".warc.gz")
+JSONL_SUFFIXES = (".jsonl", ".jsonl.gz", ".json.gz", ".ndjson", ".ndjson.gz")
+
+charsetRe = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.I)
+headerCharsetRe = re.compile(r"""charset=["']?([\w-]+)""", re.I)
+
+
+# === Inputs ===
+# Every reader yields (record_id, url, payload, http_headers) where payload is str or bytes.
+# http_headers is set for WARC responses, whose body is de-chunked and decompressed in the workers.
+# record_id must be unique across all inputs of a run since the checkpoint skips by id, so JSONL and
+# directory ids are scoped to their input path. WARC-Record-IDs are already globally unique.
+
+
+def _open(path, mode="rb"):
+    encoding = "utf-8" if "t" in mode else None
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+
+def _parse_headers(lines):
+    headers = {}
+    for line in lines:
+        name, sep, value = line.partition(b":")
+        if sep:
+            headers[name.strip().lower().decode("latin-1")] = value.strip().decode("latin-1")
+    return headers
+
+
+def _dechunk(body):
+    out = bytearray()
+    pos = 0
+    while pos < len(body):
+        eol = body.find(b"\r\n", pos)
+        if eol == -1:
+            break
+        size = int(body[pos:eol].split(b";")[0] or b"0", 16)
+        if size == 0:
+            break
+        out += body[eol + 2 : eol + 2 + size]
+        pos = eol + 2 + size + 2
+    return bytes(out)
+
+
+def _decode_http_body(body, headers):
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        body = _dechunk(body)
+    if headers.get("content-encoding", "").lower() in ("gzip", "x-gzip", "deflate"):
+        # 47 = auto-detect zlib or gzip header
+        body = zlib.decompress(body, 47)
+    return body
+
+
+def iter_warc(path):
+    with _open(path) as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            if not line.startswith(b"WARC/"):
+                raise ValueError(f"Malformed WARC record in {path}: {line[:50]!r}")
+
+            header_lines = []
+            for line in iter(f.readline, b""):
+                if line in (b"\r\n", b"\n"):
+                    break
+                header_lines.append(line.rstrip(b"\r\n"))
+            headers = _parse_headers(header_lines)
+            block = f.read(int(headers.get("content-length", 0)))
+
+            record_type = headers.get("warc-type", "")
+            url = headers.get("warc-target-uri", "")
+            record_id = headers.get("warc-record-id", url)
+            content_type = headers.get("content-type", "")
+
+            if record_type == "response" and content_type.startswith("application/http"):
+                head, _, body = block.partition(b"\r\n\r\n")
+                http_headers = _parse_headers(head.split(b"\r\n")[1:])
+                http_content_type = http_headers.get("content-type", "")
+                if http_content_type and "html" not in http_content_type:
+                    continue
+                yield record_id, url, body, http_headers
+            elif record_type == "resource" and "html" in content_type:
+                yield record_id, url, block, None
+
+
+def iter_jsonl(path, html_field="html"):
+    with _open(path, "rt") as f:
+        for line_no, line in enumerate(f):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            url = row.get("url", "")
+            record_id = f"{path}:{row.get('id') or line_no}"
+            yield record_id, url, row.get(html_field) or "", None
+
+
+def iter_html_dir(path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.lower().endswith(HTML_SUFFIXES):
+                continue
+            file_path = os.path.join(root, name)
+            with _open(file_path) as f:
+                yield file_path, "", f.read(), None
+
+
+def iter_inputs(paths, html_field="html"):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_html_dir(path)
+        elif path.endswith(WARC_SUFFIXES):
+            yield from iter_warc(path)
+        elif path.endswith(JSONL_SUFFIXES):
+            yield from iter_jsonl(path, html_field)
+        else:
+            raise ValueError(f"Unsupported input: {path}")
+
+
+# === Outputs ===
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        # Opened in append mode so a resumed run continues the same file
+        self.f = _open(path, "at")
+
+    def write(self, row):
+        self.f.write(json.dumps(row) + "\n")
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter:
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow. Install it with `pip install pyarrow`.")
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        # Fixed so every part has the same column types, e.g. `error` is string even in an error-free part
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in ("id", "url", "title", "text", "error")])
+        self.path = path
+        self.rows = []
+        os.makedirs(path, exist_ok=True)
+        # One part file per flush, numbered after any parts left by a previous run
+        self.part = len([x for x in os.listdir(path) if x.endswith(".parquet")])
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+        table = self.pa.Table.from_pylist(self.rows, schema=self.schema)
+        self.pq.write_table(table, os.path.join(self.path, f"part-{self.part:05d}.parquet"))
+        self.part += 1
+        self.rows = []
+
+    def close(self):
+        # Unflushed rows are dropped; run() always flushes through commit() so they get checkpointed
+        self.rows = []
+
+
+def _get_writer(path, output_format):
+    if output_format == "parquet" or (output_format is None and path.endswith(".parquet")):
+        return ParquetWriter(path)
+    return JsonlWriter(path)
+
+
+def _load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(line.rstrip("\n") for line in f if line.strip())
+
+
+# === Workers ===
+
+_is_blog = False
+
+
+def _init_worker(is_blog, log_level):
+    global _is_blog
+    _is_blog = is_blog
+    # Readable logs every node it touches; keep workers quiet unless asked otherwise
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+
+
+def _to_text(payload, http_headers=None):
+    if isinstance(payload, str):
+        return payload
+    # Charset from the HTTP Content-Type first, then <meta charset>, then UTF-8
+    header_match = headerCharsetRe.search((http_headers or {}).get("content-type", ""))
+    meta_match = None if header_match else charsetRe.search(payload[:2048])
+    if header_match:
+        encoding = header_match.group(1)
+    elif meta_match:
+        encoding = meta_match.group(1).decode("ascii")
+    else:
+        encoding = "utf-8"
+    try:
+        return payload.decode(encoding, errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+def _extract(record):
+    record_id, url, payload, http_headers = record
+    timings = {}
+    title, text, err = "", "", None
+
+    t0 = time.perf_counter()
+    try:
+        if http_headers is not None:
+            payload = _decode_http_body(payload, http_headers)
+    except (ValueError, zlib.error) as e:
+        # A corrupt record fails on its own instead of taking the whole job down
+        row = {"id": record_id, "url": url, "title": "", "text": "", "error": f"Failed to decode HTTP body: {e}"}
+        return row, timings
+    html = _to_text(payload, http_headers)
+    timings["decode"] = time.perf_counter() - t0
+
+    tmp = Readable()
+    # Used by _fix_links to absolutize links in the article content
+    tmp.url = url
+    try:
+        tmp.run_html(html)
+        title = tmp.title
+        text = tmp.text
+        if _is_blog and tmp.article_content:
+            text = tmp.article_text
+    except Exception as e:
+        err = str(e) or type(e).__name__
+    timings.update(getattr(tmp, "timings", {}))
+
+    row = {"id": record_id, "url": url, "title": title, "text": text, "error": err}
+    return row, timings
+
+
+# === Driver ===
+
+
+class Stats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.pages = 0
+        self.errors = 0
+        self.stage_totals = {}
+
+    def add(self, row, timings):
+        self.pages += 1
+        if row["error"] is not None:
+            self.errors += 1
+        for stage, seconds in timings.items():
+            self.stage_totals[stage] = self.stage_totals.get(stage, 0) + seconds
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.start
+        rate = self.pages / elapsed if elapsed else 0
+        print(f"{self.pages} pages ({self.errors} errors) in {elapsed:.1f}s, {rate:.1f} pages/sec", file=sys.stderr)
+        if final and self.pages:
+            for stage, seconds in self.stage_totals.items():
+                print(f"  {stage:<12} {1000 * seconds / self.pages:8.2f} ms/page", file=sys.stderr)
+        self.last_report = time.perf_counter()
+
+
+def run(
+    inputs,
+    output,
+    output_format=None,
+    checkpoint=None,
+    processes=None,
+    chunksize=16,
+    flush_every=1000,
+    is_blog=False,
+    html_field="html",
+    log_level="WARNING",
+    report_every=10.0,
+):
+    processes = processes or os.cpu_count() or 1
+    checkpoint = checkpoint or f"{output.rstrip('/')}.checkpoint"
+    done = _load_checkpoint(checkpoint)
+    if done:
+        print(f"Resuming: skipping {len(done)} already extracted records", file=sys.stderr)
+
+    # Pool.imap drains its input eagerly; bound the number of records in flight so
+    # large archives stream through instead of being read into memory up front.
+    in_flight = threading.Semaphore(processes * chunksize * 4)
+    stop = threading.Event()
+
+    def records():
+        for record in iter_inputs(inputs, html_field):
+            if record[0] in done:
+                continue
+            while not in_flight.acquire(timeout=1):
+                if stop.is_set():
+                    return
+            yield record
+
+    writer = _get_writer(output, output_format)
+    ckpt = open(checkpoint, "a")
+    stats = Stats()
+    pending = []
+
+    def commit():
+        # Checkpoint only after the rows are durably written
+        writer.flush()
+        ckpt.write("".join(f"{record_id}\n" for record_id in pending))
+        ckpt.flush()
+        pending.clear()
+
+    try:
+        with Pool(processes, initializer=_init_worker, initargs=(is_blog, log_level)) as pool:
+            for row, timings in pool.imap_unordered(_extract, records(), chunksize):
+                in_flight.release()
+                writer.write(row)
+                pending.append(row["id"])
+                stats.add(row, timings)
+                if len(pending) >= flush_every:
+                    commit()
+                if time.perf_counter() - stats.last_report >= report_every:
+                    stats.report()
+    finally:
+        stop.set()
+        # Also on failure: whatever the writer persists must be in the checkpoint, or a resumed run
+        # extracts and writes those records again
+        try:
+            commit()
+        finally:
+            writer.close()
+            ckpt.close()
+
+    stats.report(final=True)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract readable text from stored HTML without a browser.")
+    parser.add_argument("inputs", nargs="+", help="WARC(.gz), JSONL(.gz) files or directories of HTML files")
+    parser.add_argument("-o", "--output", required=True, help="JSONL(.gz) file or Parquet directory")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default=None, help="Defaults to the output suffix")
+    parser.add_argument("--checkpoint", default=None, help="Defaults to <output>.checkpoint")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="Defaults to all cores")
+    parser.add_argument("--chunksize", type=int, default=16, help="Records handed to a worker at a time")
+    parser.add_argument("--flush-every", type=int, default=1000, help="Records between output/checkpoint flushes")
+    parser.add_argument("--is-blog", action="store_true", help="Emit article text instead of full-page text")
+    parser.add_argument("--html-field", default="html", help="JSONL field holding the HTML")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    run(
+        args.inputs,
+        args.output,
+        output_format=args.format,
+        checkpoint=args.checkpoint,
+        processes=args.processes,
+        chunksize=args.chunksize,
+        flush_every=args.flush_every,
+        is_blog=args.is_blog,
+        html_field=args.html_field,
+        log_level=args.log_level,
+    )
+
+
+if __name__ == "__main__":
+    main()
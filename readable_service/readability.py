@@ -1,9 +1,11 @@
+import asyncio
 import math
 import re
+import time
 import unicodedata
 
 from bs4 import BeautifulSoup
-from html2text import html2text
+from bs4.element import NavigableString, PreformattedString
 from loguru import logger
 from urllib.parse import urljoin
 
@@ -33,72 +35,367 @@ regexps = {
     "killBreaksRe": re.compile(r"(<br\s*\/?>(\s|&nbsp;?)*){1,}", re.I),
     "videoRe": re.compile(r"http:\/\/(www\.)?(youtube|vimeo|youku|tudou|56|yinyuetai)\.com", re.I),
     "attributeRe": re.compile(r"blog|post|article", re.I),
+    "whitespaceRe": re.compile(r"\s+"),
 }
 
 
+# Tags handled by html_to_text
+SKIP_TAGS = {"head", "script", "style", "noscript", "template", "svg", "iframe", "object", "embed", "select", "button"}
+PARAGRAPH_TAGS = {"p", "blockquote", "pre", "table", "dl", "figure", "hr", "h1", "h2", "h3", "h4", "h5", "h6"}
+LINE_TAGS = set(
+    "div section article main header footer nav aside form address center li tr dt dd figcaption caption details "
+    "summary".split()
+)
+EMPHASIS_MARKERS = {"em": "_", "i": "_", "strong": "**", "b": "**", "code": "`", "del": "~~", "s": "~~"}
+
+
+class _TextSerializer:
+    # Single pass over an already parsed tree. Text is buffered in `parts`; block boundaries only record
+    # how many newlines are owed, and they are written lazily before the next text so blocks never
+    # produce leading, trailing or stacked blank lines.
+
+    def __init__(self, markdown):
+        self.markdown = markdown
+        self.parts = []
+        self.breaks = 0
+        # Blank lines between blocks take the quote depth of the shallower block, so entering or
+        # leaving a blockquote doesn't leave a dangling ">" line
+        self.blank_quotes = 0
+        self.markers = []  # Index in parts of each open emphasis or link marker
+        self.pre = 0
+        self.quotes = 0
+        self.lists = []  # One [tag, item count] per open ul/ol
+        self.links = []  # href per open <a>, None when the link isn't rendered
+        self.cells = 0
+        # List bullet or cell separator owed by the current item/cell, written with its first content.
+        # Until then block breaks are ignored so "<li><p>x</p></li>" renders as "* x".
+        self.pending = None
+        self.pending_indent = None
+
+    def _flush(self, indent=None):
+        if self.breaks:
+            if indent is None:
+                indent = len(self.lists) if self.markdown else 0
+            blank = ("> " * min(self.blank_quotes, self.quotes)).rstrip()
+            line = "> " * self.quotes + "  " * indent
+            if self.parts:
+                self.parts.append(("\n" + blank) * (self.breaks - 1) + "\n" + line)
+            elif line:
+                self.parts.append(line)
+        self.breaks = 0
+        self.blank_quotes = self.quotes
+
+    def _write(self, s, indent=None):
+        if self.pending is not None:
+            self._flush(self.pending_indent)
+            if self.pending:
+                self.parts.append(self.pending)
+            self.pending = None
+        else:
+            self._flush(indent)
+        if s:
+            self.parts.append(s)
+
+    def _set_pending(self, marker, indent=None):
+        if self.pending is not None:
+            # The previous item or cell had no content of its own, e.g. a nested list directly in an <li>
+            self._write("")
+            self._block(1 if indent is not None else 0)
+        self.pending = marker
+        self.pending_indent = indent
+
+    def _block(self, n):
+        if self.pending is not None:
+            return
+        self.breaks = max(self.breaks, n)
+        self.blank_quotes = min(self.blank_quotes, self.quotes)
+
+    def _ends_with_space(self):
+        return not self.parts or self.parts[-1][-1:].isspace() or self.breaks or self.pending is not None
+
+    def _opened(self):
+        # True if the last part is an opening marker with nothing written after it yet
+        return bool(self.markers) and self.markers[-1] == len(self.parts) - 1
+
+    def _open(self, marker):
+        self._write(marker)
+        self.markers.append(len(self.parts) - 1)
+
+    def _close(self, marker):
+        # Drops markers around nothing but whitespace and keeps trailing whitespace outside them: "_a _" -> "_a_ "
+        start = self.markers.pop()
+        inner = self.parts[start + 1 :]
+        if all(not part.strip() for part in inner):
+            del self.parts[start:]
+            if any(inner) and not self._ends_with_space():
+                self.parts.append(" ")
+            return
+        trailing = self.parts[-1].endswith(" ")
+        if trailing:
+            self.parts[-1] = self.parts[-1].rstrip(" ")
+        self.parts.append(marker + " " * trailing)
+
+    def text(self, s):
+        s = unicodedata.normalize("NFKD", s)
+        if self.pre:
+            self._write(s)
+            return
+        s = regexps["whitespaceRe"].sub(" ", s)
+        if s[:1] == " " and self._opened():
+            # Keep leading whitespace outside every enclosing marker that is still empty: "**_ a_**" -> " **_a_**"
+            n = 1
+            while n < len(self.markers) and self.markers[-1 - n] == len(self.parts) - 1 - n:
+                n += 1
+            opened = self.parts[-n:]
+            del self.parts[-n:]
+            if not self._ends_with_space():
+                self.parts.append(" ")
+            for i in range(n):
+                self.markers[i - n] = len(self.parts) + i
+            self.parts.extend(opened)
+            s = s.lstrip()
+        elif self._ends_with_space():
+            s = s.lstrip()
+        if s:
+            self._write(s)
+
+    def start(self, tag):
+        name = tag.name
+        if name in PARAGRAPH_TAGS:
+            self._block(2)
+        elif name in LINE_TAGS:
+            self._block(1)
+
+        if name == "br":
+            if self.pending is None:
+                self.breaks = min(self.breaks + 1, 2)
+        elif name == "pre":
+            if self.markdown:
+                self._write("```")
+                self._block(1)
+            self.pre += 1
+        elif name == "blockquote" and self.markdown:
+            self.quotes += 1
+        elif name in ("ul", "ol"):
+            self._block(2 if not self.lists else 1)
+            start = tag.get("start", "1") if name == "ol" else "1"
+            self.lists.append([name, int(start) - 1 if start.strip().lstrip("-").isdigit() else 0])
+        elif name == "li":
+            marker = ""
+            if self.lists:
+                self.lists[-1][1] += 1
+            if self.markdown and self.lists:
+                kind, count = self.lists[-1]
+                marker = f"{count}. " if kind == "ol" else "* "
+            self._set_pending(marker, len(self.lists) - 1 if self.markdown and self.lists else 0)
+        elif name in ("tr", "table"):
+            if name == "tr" and self.cells:
+                self.breaks = 1  # One row per line, even if the previous row's cells held paragraphs
+            self.cells = 0
+        elif name in ("td", "th"):
+            # Cells are inline; drop the breaks owed by the previous cell's blocks
+            if self.cells:
+                self.breaks = 0
+            self._set_pending((" | " if self.markdown else " ") if self.cells else "")
+            self.cells += 1
+        elif not self.markdown:
+            pass
+        elif len(name) == 2 and name[0] == "h" and name[1] in "123456":
+            self._write("#" * int(name[1]) + " ")
+        elif name == "hr":
+            self._write("* * *")
+        elif name == "img":
+            src = tag.get("src")
+            if src:
+                self._write(f"![{tag.get('alt', '')}]({src})")
+        elif name == "a":
+            href = tag.get("href")
+            if href and not href.startswith(("#", "javascript:")) and not self.pre:
+                self._open("[")
+                self.links.append(href)
+            else:
+                self.links.append(None)
+        elif name in EMPHASIS_MARKERS and not self.pre:
+            self._open(EMPHASIS_MARKERS[name])
+
+    def end(self, tag):
+        name = tag.name
+        if name == "pre":
+            self.pre -= 1
+            # The newline ending the <pre> body would otherwise add a blank line before what follows
+            if self.parts and self.parts[-1].endswith("\n"):
+                self.parts[-1] = self.parts[-1][:-1]
+            if self.markdown:
+                self._block(1)
+                self._write("```")
+        elif name == "blockquote" and self.markdown:
+            self.quotes -= 1
+            self.blank_quotes = min(self.blank_quotes, self.quotes)
+        elif name == "li" and self.pending is not None:
+            self.pending = None  # Empty item, drop its bullet
+        elif name in ("td", "th") and self.pending is not None:
+            self._write("")  # Empty cell, keep its separator so the columns line up
+        elif name in ("ul", "ol"):
+            self.lists.pop()
+            self._block(2 if not self.lists else 1)
+        elif not self.markdown:
+            pass
+        elif name == "a" and self.links:
+            href = self.links.pop()
+            if href is not None:
+                self._close(f"]({href})")
+        elif name in EMPHASIS_MARKERS and not self.pre:
+            self._close(EMPHASIS_MARKERS[name])
+
+        if name in PARAGRAPH_TAGS:
+            self._block(2)
+        elif name in LINE_TAGS:
+            self._block(1)
+
+    def serialize(self, node):
+        # Iterative walk; deeply nested pages would overflow the recursion limit
+        stack = [(node, False)]
+        while stack:
+            node, closing = stack.pop()
+            if closing:
+                self.end(node)
+            elif isinstance(node, NavigableString):
+                if not isinstance(node, PreformattedString):  # comments, doctypes, CDATA, ...
+                    self.text(node)
+            elif node.name not in SKIP_TAGS:
+                self.start(node)
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.contents))
+        return "".join(self.parts).strip() + "\n"
+
+
+def html_to_text(node, markdown=True):
+    """Serializes a parsed bs4 tree (or any tag in it) to NFKD normalized text.
+
+    With markdown=True, headings, lists, links, images, emphasis and code blocks are rendered as
+    markdown, similar to html2text. With markdown=False only the block structure is kept.
+    """
+    return _TextSerializer(markdown).serialize(node)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
 class Readable:
-    def run(self, url):
+    # time.monotonic() value after which fetching and extraction are abandoned. None means no deadline.
+    deadline = None
+
+    def run(self, url, timeout=None):
         self.url = url
+        self._set_deadline(timeout)
         self.response = self._get_response()
-        self.text = html2text(self.html_content)
-        self.text = unicodedata.normalize("NFKD", self.text)
-        print(self.text[:2000])
         self.soup = self._get_soup()
-        self.title = self.soup.title.text
-        self.article_content = str(self._grab_article_content())
+        self.text = html_to_text(self.soup)
+        print(self.text[:2000])
+        self._check_deadline()
+        self.title = self.soup.title.text if self.soup.title is not None else ""
+        article_content = self._grab_article_content()
+        self.article_content = str(article_content)
+        self.article_text = html_to_text(article_content, markdown=False)
         self.soup = (
             self._get_soup()
         )  # Reset soup to the original content because while grabbing article content, we modify the soup
 
-    async def arun(self, url):
+    async def arun(self, url, timeout=None):
         self.url = url
+        self._set_deadline(timeout)
         # self.response = await self._get_response()
         # self.html_content = self.response.text
-        await self._aget_response()
-        self.text = html2text(self.html_content)
-        self.text = unicodedata.normalize("NFKD", self.text)
+        try:
+            await self._aget_response()
+            # Extraction is CPU bound; run it off the event loop so other requests and disconnect checks keep going
+            await asyncio.to_thread(self.run_html, self.html_content)
+        except asyncio.CancelledError:
+            # Threads (the requests fallback, extraction) can't be interrupted, so expire the deadline to stop
+            # them at their next deadline check
+            self.deadline = time.monotonic()
+            raise
         print(self.text[:2000])
-        self.soup = self._get_soup()
-        self.title = self.soup.title.text
-        self.article_content = str(self._grab_article_content())
-        self.soup = (
-            self._get_soup()
-        )  # Reset soup to the original content because while grabbing article content, we modify the soup
 
-    def run_html(self, html):
+    def run_html(self, html, timeout=None):
+        if timeout is not None:
+            self._set_deadline(timeout)
+        t0 = time.perf_counter()
         self.html_content = html
-        self.text = html2text(self.html_content)
-        self.text = unicodedata.normalize("NFKD", self.text)
         self.soup = self._get_soup()
-        self.title = self.soup.title.text
-        self.article_content = str(self._grab_article_content())
+        self.title = self.soup.title.text if self.soup.title is not None else ""
+        t1 = time.perf_counter()
+        self._check_deadline()
+        # Serialize before _grab_article_content, which modifies the soup
+        self.text = html_to_text(self.soup)
+        t2 = time.perf_counter()
+        self._check_deadline()
+        article_content = self._grab_article_content()
+        self.article_content = str(article_content)
+        self.article_text = html_to_text(article_content, markdown=False)
+        t3 = time.perf_counter()
         self.soup = self._get_soup()
+        t4 = time.perf_counter()
+        # Per-stage wall time in seconds, reported by the bulk extractor
+        self.timings = {"parse": t1 - t0, "text": t2 - t1, "article": t3 - t2, "reset": t4 - t3}
+
+    def _set_deadline(self, timeout):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+
+    def _check_deadline(self):
+        # Returns the seconds left before the deadline, or None if there is no deadline
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline exceeded while processing url: {getattr(self, 'url', None)}")
+        return remaining
+
+    def _check_deadline_ms(self):
+        # Playwright takes milliseconds and treats 0 as "no timeout"
+        remaining = self._check_deadline()
+        return None if remaining is None else max(1, int(remaining * 1000))
 
     def _grab_article_content(self):
         self._trash_bad_nodes()
+        self._check_deadline()
         candidates = self._assign_content_score_to_paras()
         top_candidate = self._get_top_candidate(candidates)
         article_content = self._create_article_content(top_candidate)
+        self._check_deadline()
         self._prepare_article_content(article_content)
         return article_content
 
     def _plain_old_request(self):
         import requests
 
-        res = requests.get(self.url)
+        # requests' timeout applies to the connect and to each read, not to the whole download, so a slow
+        # server could keep this running past the deadline. Stream the body and check between chunks.
+        with requests.get(self.url, timeout=self._check_deadline(), stream=True) as res:
+            chunks = []
+            for chunk in res.iter_content(chunk_size=64 * 1024):
+                self._check_deadline()
+                chunks.append(chunk)
+        # Hand the body back to the response so res.text decodes it as before: res.encoding, or
+        # res.apparent_encoding when the response has no charset
+        res._content = b"".join(chunks)
+        text = res.text
         if res.status_code != 200:
-            raise Exception(f"Failed to get url: {self.url}. Error code: {res.status_code}. Error message: {res.text}")
-        self.html_content = res.text
+            raise Exception(f"Failed to get url: {self.url}. Error code: {res.status_code}. Error message: {text}")
+        self.html_content = text
 
     def _get_response(self):
         try:
             with sync_playwright() as p:
                 browser = p.chromium.launch()
-                page = browser.new_page()
-                page.goto(self.url)
-                self.html_content = page.content()
-                browser.close()
-                return
+                try:
+                    page = browser.new_page()
+                    page.goto(self.url, timeout=self._check_deadline_ms())
+                    self.html_content = page.content()
+                    return
+                finally:
+                    browser.close()
         except Exception as e:
             logger.error(e)
 
@@ -108,15 +405,18 @@ class Readable:
         try:
             async with async_playwright() as p:
                 browser = await p.chromium.launch()
-                page = await browser.new_page()
-                await page.goto(self.url)
-                self.html_content = await page.content()
-                await browser.close()
-                return
+                # Close the browser on every exit, including cancellation when the client disconnects
+                try:
+                    page = await browser.new_page()
+                    await page.goto(self.url, timeout=self._check_deadline_ms())
+                    self.html_content = await page.content()
+                    return
+                finally:
+                    await browser.close()
         except Exception as e:
             logger.error(e)
 
-        self._plain_old_request()
+        await asyncio.to_thread(self._plain_old_request)
 
     def _get_soup(self):
         return BeautifulSoup(self.html_content, "lxml")
@@ -448,9 +748,6 @@ class Readable:
 
 
 if __name__ == "__main__":
-    import asyncio
-    import time
-
     start = time.time()
     tmp = Readable()
     asyncio.run(tmp.run("https://scottsdaleveterinaryclinic.com/pet-services/"))